@@ -25,7 +25,6 @@ parser.add_argument('-i', type=int, dest='iterations', default=2, metavar='itera
 args = parser.parse_args()
 
 channels = active_channels()
-for idx, ch in enumerate(channels):
-	vautoscale(ch, args.iterations, args.vdiv)
+vautoscale(channels, args.iterations, args.vdiv)
 
 close_resources()
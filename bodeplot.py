@@ -14,21 +14,23 @@ import math
 import time
 import re
 import argparse
+import concurrent.futures
 import pyvisa
+import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
 from eelib import *
 
-def wait():
-	"""Small delay for DSO or AWG command processing."""
-	time.sleep(args.delay)
-	time.sleep(0.1)
-	awg.query("*OPC?")
+def sync():
+	"""Waits for AWG and DSO command processing."""
+	# Both instruments are polled concurrently
+	opc = executor.submit(awg.query, "*OPC?")
 	dso.query("*OPC?")
+	opc.result()
 
-def step(f):
-	"""Computes frequency sweep step size for given frequency."""
-	p = math.floor(math.log10(f))
-	return round((10 ** p) / args.quality)
+def settle(t):
+	"""Delay for signals to settle."""
+	time.sleep(t)
 
 def plotvpp(xpts, vpps1, vpps2, phases):
 	"""Plots Vpp and phase difference of two channels on logarithmic scales."""
@@ -48,6 +50,7 @@ def plotvpp(xpts, vpps1, vpps2, phases):
 	ax2.plot(xpts, phases, color='red', label="Phase")
 	ax2.tick_params(axis ='y', labelcolor='red')
 	fig.tight_layout()
+	return fig
 	
 def plotvdb(xpts, vdbs, phases):
 	"""Plots dBV and phase difference on logarithmic scales."""
@@ -64,6 +67,7 @@ def plotvdb(xpts, vdbs, phases):
 	ax2.plot(xpts, phases, color='red', label="Phase")
 	ax2.tick_params(axis ='y', labelcolor='red')
 	fig.tight_layout()
+	return fig
 
 parser = argparse.ArgumentParser(
 	description="Bode Plot",
@@ -79,13 +83,15 @@ parser.add_argument('-a1', type=int, dest='attn1', default=10, metavar='attenuat
 parser.add_argument('-a2', type=int, dest='attn2', default=10, metavar='attenuation', help="Probe attenuation factor for outchannel (default is 10)")
 parser.add_argument('-q', type=int, choices=range(1, 11), dest='quality', default=1, metavar='quality', help="Output quality ([1-10], default is 1)")
 parser.add_argument('-d', type=float, dest='delay', default=0, metavar='delay', help="Delay between measurements in seconds (default is 0)")
+parser.add_argument('-png', type=str, dest='png', default=None, metavar='prefix', help="Save plots as PNG files with given prefix instead of showing them")
 args = parser.parse_args()
 
 awgch = f"C{args.cawg}"
 dsoch1 = f"C{args.cin}" # Channel for measuring AWG output
 dsoch2 = f"C{args.cout}" # DUT channel
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
-wait()
+sync()
 
 # AWG setup: sine wave, amplitude, HiZ output ON
 awg.write(f"{awgch}:OUTP LOAD,HZ,PLRT,NOR")
@@ -95,77 +101,85 @@ awg.write(f"{awgch}:BSWV OFST,0")
 awg.write(f"{awgch}:BSWV AMP,{args.amp}")
 awg.write(f"{awgch}:OUTP ON")
 
-# DSO general setup
-dso.write(f"CHDR SHORT")
-dso.write(f"MSIZ 7M")
-dso.write(f"MENU ON") # Actually turns the menu off
-hs = hscale(args.fs)
-dso.write(f"TDIV {hs}")
+# DSO general setup, sent as a single compound command
+tdiv = hscale(args.fs)
+cmds = ["CHDR SHORT", "MSIZ 7M", "MENU ON", f"TDIV {tdiv}"] # MENU ON actually turns the menu off
 
 # DSO channels setup: attenuation, bandwidth limit OFF, DC coupling, zero offset, V unit, 150mV divisions
-dso.write(f"{dsoch1}:ATTN {args.attn1}")
-dso.write(f"{dsoch2}:ATTN {args.attn2}")
+cmds.append(f"{dsoch1}:ATTN {args.attn1}")
+cmds.append(f"{dsoch2}:ATTN {args.attn2}")
 for ch in [dsoch1, dsoch2]:
-	dso.write(f"{ch}:BWL OFF")
-	dso.write(f"{ch}:CPL D1M")
-	dso.write(f"{ch}:OFST 0V")
-	dso.write(f"{ch}:UNIT V")
-	dso.write(f"{ch}:VDIV {vunit(args.amp / 7.5)}")
+	cmds.append(f"{ch}:BWL OFF")
+	cmds.append(f"{ch}:CPL D1M")
+	cmds.append(f"{ch}:OFST 0V")
+	cmds.append(f"{ch}:UNIT V")
+	cmds.append(f"{ch}:VDIV {vunit(args.amp / 7.5)}")
 
 # DSO trigger setup: edge trigger at 0V for AWG output channel
-dso.write(f"{dsoch1}:TRCP DC")
-dso.write(f"{dsoch1}:TRLV 0V")
-dso.write(f"TRSE EDGE,SR,{dsoch1},HT,OFF")
-dso.write("TRMD AUTO")
+cmds.append(f"{dsoch1}:TRCP DC")
+cmds.append(f"{dsoch1}:TRLV 0V")
+cmds.append(f"TRSE EDGE,SR,{dsoch1},HT,OFF")
+cmds.append("TRMD AUTO")
+dso.write(";".join(cmds))
 
-wait()
+sync()
 
 match = re.search("^SARA (.*)Sa/s", dso.query("SARA?").strip())
 if match:
 	sr = float(match.group(1))
 	errprint(f"DSO sample rate: {sr} Sa/s")
-	
-wait()
 
-xpts = []
-vpps1 = []
-vpps2 = []
-vdbs = []
-phases = []
+# Logarithmic sweep with 9 points per decade per quality step
+npts = int(9 * args.quality * math.log10(args.fe / args.fs)) + 1 if args.fe >= args.fs else 0
+freqs = np.unique(np.round(np.logspace(math.log10(args.fs), math.log10(args.fe), npts)).astype(int))
+hscales = [hscale(f) for f in freqs]
+
+n = len(freqs)
+xpts = np.empty(n)
+vpps1 = np.empty(n)
+vpps2 = np.empty(n)
+vdbs = np.empty(n)
+phases = np.empty(n)
 
 print("    Freq,     Vpp 1,     Vpp 2,       dBV,     Phase")
-f = args.fs
-while f <= args.fe:
-	hs = hscale(f)
-	dso.write(f"TDIV {hs}")
+for i, (f, hs) in enumerate(zip(freqs, hscales)):
+	if hs != tdiv:
+		dso.write(f"TDIV {hs}")
+		tdiv = hs
 	awg.write(f"{awgch}:BSWV FRQ,{f}")
-	if f < 100: time.sleep(1)
-	wait()
+	settle(14 * hscale_seconds(hs)) # Waits for one full acquisition (14 divisions) at the new frequency
+	sync()
 
-	vautoscale(dsoch1)
-	vautoscale(dsoch2)
-	wait()
+	if vautoscale([dsoch1, dsoch2]): sync() # Measures only after a rescale has been processed
+	settle(args.delay)
 
-	vpp1 = measure_vpp(dsoch1)
-	vpp2 = measure_vpp(dsoch2)
+	vpp1, vpp2 = measure_pava([dsoch1, dsoch2], ("PKPK",))
 	vdb = dBV(vpp2 / vpp1)
 	phase = measure_phase(dsoch1, dsoch2)
 
 	print(f"{f:8.0f},{vpp1:10.5f},{vpp2:10.5f},{vdb:10.5f},{phase:10.5f}")
-	xpts.append(f);
-	vpps1.append(vpp1);
-	vpps2.append(vpp2);
-	vdbs.append(vdb);
-	phases.append(phase);
-	
-	df = step(f)
-	f += df
+	xpts[i] = f
+	vpps1[i] = vpp1
+	vpps2[i] = vpp2
+	vdbs[i] = vdb
+	phases[i] = phase
 
 awg.write(f"{awgch}:OUTP OFF")
 close_resources()
 
-plt.figure()
-plotvpp(xpts, vpps1, vpps2, phases)
-plt.figure()
-plotvdb(xpts, vdbs, phases)
-plt.show()
+# Simplify rendering of curves with many sweep points
+plt.rcParams['path.simplify'] = True
+plt.rcParams['path.simplify_threshold'] = 1.0
+plt.rcParams['agg.path.chunksize'] = 10000
+
+if args.png:
+	# Headless rendering, e.g. over SSH
+	matplotlib.use('Agg')
+	plotvpp(xpts, vpps1, vpps2, phases).savefig(f"{args.png}-vpp.png", dpi=100, bbox_inches='tight')
+	plotvdb(xpts, vdbs, phases).savefig(f"{args.png}-dbv.png", dpi=100, bbox_inches='tight')
+else:
+	plt.figure()
+	plotvpp(xpts, vpps1, vpps2, phases)
+	plt.figure()
+	plotvdb(xpts, vdbs, phases)
+	plt.show()
@@ -18,44 +18,47 @@ import datetime
 import re
 import argparse
 import pyvisa
+import numpy as np
 import matplotlib.pyplot as plt
 from eelib import *
 
-def wait():
-	"""Small delay for DSO or AWG command processing."""
-	time.sleep(0.5)
+def sync():
+	"""Waits for DSO command processing."""
 	dso.query("*OPC?")
+
+def settle(t):
+	"""Delay for signals to settle."""
+	time.sleep(t)
 	
 def position_gate_init(t, dt):
 	dso.write(f"MEGA {t - dt / 2}s")
 	dso.write(f"MEGB {t + dt / 2}s")
 	
 def position_gate(t, dt):
-	dso.write(f"MEGB {t + dt / 2}s")
-	dso.write(f"MEGA {t - dt / 2}s")
+	"""Moves the measurement gates."""
+	dso.write(f"MEGB {t + dt / 2}s;MEGA {t - dt / 2}s")
 
-def plot(iterations, xpts, ypts, channels):
+def plot(xpts, ypts, channels):
 	"""Plots V of given channels."""
 	colors = [ 'gold', 'magenta', 'cyan', 'limegreen' ]
 	fig, ax1 = plt.subplots()
 	ax1.set_title("Curve Tracer (V/t)")
 	ax1.set_xlabel("Time [s]")
 	ax1.set_ylabel("Voltage [V]")
-	for i in range(0, iterations):
-		for idx, ch in enumerate(channels):
-			label = ch if i == 0 else None
-			ax1.plot(xpts[i], ypts[i][idx], color=colors[idx], label=label)
+	for idx, ch in enumerate(channels):
+		# One call plots all iterations of a channel
+		lines = ax1.plot(xpts, ypts[:, idx, :].T, color=colors[idx])
+		lines[0].set_label(ch)
 	ax1.legend()
 
-def plotxy(iterations, ypts, channels, dclabels):
+def plotxy(ypts, channels, dclabels):
 	"""Plots X/Y."""
 	fig, ax1 = plt.subplots()
 	ax1.set_title(f"Curve Tracer ({channels[1]}/{channels[0]})")
 	ax1.set_xlabel("Voltage [V]")
 	ax1.set_ylabel("Voltage [V]")
-	for i in range(0, iterations):
-		label = dclabels[i] if len(dclabels) > 0 else None
-		ax1.plot(ypts[i][0], ypts[i][1], label=label)
+	lines = ax1.plot(ypts[:, 0, :].T, ypts[:, 1, :].T)
+	for line, label in zip(lines, dclabels): line.set_label(label)
 	if len(dclabels) > 0: ax1.legend()
 	
 parser = argparse.ArgumentParser(
@@ -103,47 +106,47 @@ if args.dcawg != 0:
 	if args.iterations > 1: dvawg = (args.vmax - args.vmin) / (args.iterations - 1)
 	iterations = args.iterations
 	
-xpts = []
-ypts = []
 dclabels = []
 
-print("  AWG DCV,      [s]", end='')
-for ch in channels: print(f",{ch:>9}", end='')
-print()
+print(",".join(["  AWG DCV", "      [s]"] + [f"{ch:>9}" for ch in channels]))
 
 dso.write(f"XYDS OFF")
 dso.write(f"PACU ALL,{channels[0]}")
 dso.write(f"MEGS ON")
-wait()
+sync()
 
 hdiv = measure_hscale();
 dt = hdiv / 4 / args.quality
 dt2 = dt / 2
+tpts = []
+t = -7 * hdiv + dt2
+while t <= 7 * hdiv - dt2:
+	tpts.append(t)
+	t = t + dt
+xpts = np.array(tpts)
+ypts = np.empty((iterations, len(channels), len(tpts)))
+
 for i in range(0, iterations):
 	dso.write(f"STOP")
 	if args.dcawg != 0:
 		awg.write(f"{dcawgch}:BSWV OFST,{vawg}")
 		dclabels.append(f"{vawg:.2f}V")
 	dso.write(f"ARM")
-	wait()
-
-	t = -7 * hdiv + dt2
-	position_gate_init(t, dt2)
-	xpts.append([])
-	ypts.append([])
-	for ch in channels: ypts[i].append([])
-	while t <= 7 * hdiv - dt2:
-		print(f"{vawg:9.5f},", end='')
-		xpts[i].append(t)
-		print(f"{t / hdiv:9.3f}", end='')
+	settle(0.5)
+	sync()
+
+	position_gate_init(-7 * hdiv + dt2, dt2)
+	lines = []
+	for j, t in enumerate(tpts):
 		position_gate(t, dt)
-		wait()
-		for idx, ch in enumerate(channels):
-			v = measure_mean(ch)
-			ypts[i][idx].append(v)
-			print(f",{v:9.5f}", end='')
-		print()
-		t = t + dt
+		sync() # Measures only after the gates have moved
+		values = measure_pava(channels, ("MEAN",))
+		parts = [f"{vawg:9.5f}", f"{t / hdiv:9.3f}"]
+		for idx, v in enumerate(values):
+			ypts[i, idx, j] = v
+			parts.append(f"{v:9.5f}")
+		lines.append(",".join(parts) + "\n")
+	sys.stdout.write("".join(lines)) # Output of an iteration in a single write
 	vawg = vawg + dvawg
 
 dso.write(f"MEGS OFF")
@@ -154,8 +157,8 @@ if awg != None:
 close_resources()
 
 plt.figure()
-plot(iterations, xpts, ypts, channels)
+plot(xpts, ypts, channels)
 plt.figure()
 if (len(channels) > 1):
-	plotxy(iterations, ypts, channels, dclabels)
+	plotxy(ypts, channels, dclabels)
 plt.show()
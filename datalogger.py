@@ -16,17 +16,16 @@ import datetime
 import re
 import argparse
 import pyvisa
-import matplotlib.pyplot as plt
+import numpy as np
 from eelib import *
 
-def wait():
-	"""Small delay for DSO or AWG command processing."""
-	time.sleep(0.5)
-	awg.query("*OPC?")
-	dso.query("*OPC?")
+def settle(t):
+	"""Delay for signals to settle."""
+	time.sleep(t)
 	
 def plot(xpts, ypts, channels):
 	"""Plots V of given channels."""
+	import matplotlib.pyplot as plt # Imported here, as it is slow to load
 	colors = [ 'gold', 'magenta', 'cyan', 'limegreen' ]
 	fig, ax1 = plt.subplots()
 	ax1.set_title("Data Logger")
@@ -49,7 +48,10 @@ parser.add_argument('-vmin', type=int, dest='vmin', default=0, metavar='vmin', h
 parser.add_argument('-vmax', type=int, dest='vmax', default=1, metavar='vmax', help="AWG maximum DC voltage (default is 1)")
 args = parser.parse_args()
 
+sys.stdout.reconfigure(line_buffering=True) # Samples show up immediately when piped, e.g. to tee
+
 awgch = f"C{args.cawg}"
+ofstcmd = f"{awgch}:BSWV OFST," # Reused for every sample
 dvawg = 0
 
 scrollmode = dso.query("SAST?").strip() == "SAST Roll"
@@ -68,40 +70,41 @@ elif args.limit != 0:
 	dvawg = (args.vmax - args.vmin) / (args.limit - 1)
 
 channels = active_channels()
-xpts = []
-ypts = []
+# Samples are only kept for plotting, which requires a sample limit
+record = args.limit > 0
+if record:
+	xpts = np.empty(args.limit)
+	ypts = np.empty((len(channels), args.limit), dtype=np.float32)
 
-print("                 Timestamp,      [s]", end='')
-for ch in channels:
-	print(f",{ch:>9}", end='')
-	ypts.append([])
-print()
+print(",".join(["                 Timestamp", "      [s]"] + [f"{ch:>9}" for ch in channels]))
 
 n = 0
 start = None
+deadline = time.monotonic()
 vawg = args.vmin
 while n < args.limit or args.limit == 0:
 	if dvawg != 0:
-		awg.write(f"{awgch}:BSWV OFST,{vawg}")
+		awg.write(f"{ofstcmd}{vawg}")
 		vawg = vawg + dvawg
-		wait()
+		settle(0.5)
 
-	v = []
 	now = datetime.datetime.now()
 	if start == None: start = now
 	elapsed = (now - start).total_seconds()
-	xpts.append(elapsed)
-	print(f"{now},{elapsed:9.3f}", end='')
-	for idx, ch in enumerate(channels):
-		v = measure_level(ch)
-		ypts[idx].append(v)
-		print(f",{v:9.5f}", end='')
-	print()
+	values = measure_pava(channels, ("LEVELX",))
+	if record:
+		xpts[n] = elapsed
+		ypts[:, n] = values
+	parts = [f"{now}", f"{elapsed:9.3f}"] + [f"{v:9.5f}" for v in values]
+	sys.stdout.write(",".join(parts) + "\n") # Single write per sample
 	n = n + 1
-	time.sleep(args.interval)
+	# Sleeps until the next sample is due, so measurement time does not add to the interval.
+	# After a stall, the schedule restarts from now instead of catching up with back-to-back samples.
+	deadline = max(deadline + args.interval, time.monotonic())
+	time.sleep(max(0, deadline - time.monotonic()))
 
 close_resources()
 
-if args.plot:
-	plot(xpts, ypts, channels)
+if args.plot and record:
+	plot(xpts[:n], ypts[:, :n], channels)
 	
\ No newline at end of file
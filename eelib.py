@@ -3,13 +3,30 @@
 import time
 import sys
 import math
-import array
+import bisect
 import re
 import struct
+import socket
 import enum
+import functools
 import pyvisa
 import configparser
 
+MAX_RESPONSE = 40 # Longer query responses overflow the SDS1104X-U SCPI buffer
+TRA_SIZE = 10 # Maximum length of a TRA query response, e.g. "C1:TRA OFF"
+PAVA_SIZE = 25 # Maximum length of a PAVA query response, e.g. "C1:PAVA LEVELX,-1.23E-01V"
+CAL_SIZE = 18 # Maximum length of a VDIV or OFST query response, e.g. "C1:OFST -1.00E-01V"
+
+# Sample count query response, e.g. "SANU 14000pts"
+_SANU_RE = re.compile(r"^SANU (.*)pts$")
+
+# VISA resource names of supported instruments
+_INSTR_RES = {
+	'dso': re.compile(r"::SDS.*::INSTR$"),
+	'awg': re.compile(r"::SDG.*::INSTR$"),
+	'psu': re.compile(r"::SPD.*::INSTR$"),
+}
+
 def errprint(*args, **kwargs):
 	print(*args, file=sys.stderr, **kwargs)
 	
@@ -22,74 +39,146 @@ def norm_angle(x: float) -> float:
 		x += 360
 	return x
 
+# Voltage units, in ascending order
+_VUNIT_FACTORS = (1e-6, 1e-3, 1)
+_VUNIT_UNITS = ("uV", "mV", "V")
+
 def vunit(v):
 	"""Returns voltage with proper unit."""
-	units = ("V", "mV", "uV")
-	factors = (1, 1e-3, 1e-6)
-	for i in range(0, len(units)):
-		if abs(v) >= factors[i]: return f"{v / factors[i]}{units[i]}"
-	return "1uV"
+	i = bisect.bisect_right(_VUNIT_FACTORS, abs(v)) - 1
+	if i < 0: return "1uV"
+	return f"{v / _VUNIT_FACTORS[i]}{_VUNIT_UNITS[i]}"
+
+def parse_float(s, prefix, unit = ""):
+	"""Returns numeric value of a query response, or None if malformed or unavailable."""
+	# Fixed format, e.g. "C1:VDIV 5.00E-01V" with prefix "C1:VDIV ". Checking the prefix rejects
+	# the response to a previous query, which the SDS1104X-U may return when in a bad state.
+	if not (s.startswith(prefix) and s.endswith(unit)): return None
+	try:
+		return float(s[len(prefix):len(s) - len(unit)])
+	except ValueError:
+		return None
+
+_TRA_QUERIES = [f"{ch}:TRA?" for ch in ['C1', 'C2', 'C3', 'C4']]
 
 def active_channels():
 	"""Returns active DSO channels."""
 	channels = []
-	for ch in ['C1', 'C2', 'C3', 'C4']:
-		s = dso.query(f"{ch}:TRA?").strip()
-		match = re.search("^(C\d):TRA ON$", s)
-		if match: channels.append(match.group(1))
+	for s in query_chain(_TRA_QUERIES, TRA_SIZE):
+		if s.endswith(":TRA ON"): channels.append(s.partition(":")[0])
 	return channels
 
+# Vertical scale and offset of DSO channels, by channel
+_chan_cal = {}
+
+def measure_cal(channels):
+	"""Returns vertical scale and offset of given DSO channels, ordered by channel."""
+	# Cached until changed by vautoscale; uncached channels are queried together
+	missing = [ch for ch in channels if ch not in _chan_cal]
+	queries = [f"{ch}:{q}?" for ch in missing for q in ("VDIV", "OFST")]
+	values = []
+	for q, s in zip(queries, query_chain(queries, CAL_SIZE)):
+		v = parse_float(s, f"{q[:-1]} ", "V") # Response header echoes the query, e.g. "C1:VDIV "
+		if v is not None:
+			values.append(v)
+		else:
+			errprint(f"Error parsing: {s}")
+			sys.exit(7 if q.endswith("VDIV?") else 8)
+	for idx, ch in enumerate(missing):
+		_chan_cal[ch] = (values[2 * idx], values[2 * idx + 1])
+	return [_chan_cal[ch] for ch in channels]
+
 def measure_vscale(ch):
 	"""Returns vertical scale per division."""
-	s = dso.query(f"{ch}:VDIV?").strip()
-	match = re.search(f"^{ch}:VDIV ([-+0-9.E]+)V$", s)
-	if match:
-		v = float(match.group(1))
-	else:
-		errprint(f"Error parsing: {s}")
-		sys.exit(7)
-	return v
+	return measure_cal([ch])[0][0]
 
 def measure_voffset(ch):
 	"""Returns vertical offset."""
-	s = dso.query(f"{ch}:OFST?").strip()
-	match = re.search(f"^{ch}:OFST ([-+0-9.E]+)V$", s)
-	if match:
-		v = float(match.group(1))
-	else:
-		errprint(f"Error parsing: {s}")
-		sys.exit(8)
-	return v
+	return measure_cal([ch])[0][1]
+
+def query_chain(queries, size):
+	"""Returns DSO responses to queries, chaining as many queries per transaction as possible."""
+	# Chained responses are separated by ';' and must not exceed MAX_RESPONSE bytes in total
+	k = max(1, (MAX_RESPONSE + 1) // (size + 1))
+	responses = []
+	for i in range(0, len(queries), k):
+		s = dso.query(";".join(queries[i:i + k])).strip()
+		parts = s.split(";")
+		if len(parts) != len(queries[i:i + k]):
+			errprint(f"Error parsing: {s}")
+			sys.exit(9)
+		responses.extend(parts)
+	return responses
+
+@functools.lru_cache
+def pava_queries(channels, params):
+	"""Returns PAVA queries for given DSO channels and parameters."""
+	# Cached, as the same queries are repeated for every measurement
+	return tuple(f"{ch}:PAVA? {p}" for ch in channels for p in params)
+
+def measure_pava(channels, params, exitcode = 2):
+	"""Returns measurements of given DSO channels, ordered by channel and then by parameter."""
+	# Assumes optimal vertical scale. Exits with the given code if a response is malformed.
+	queries = pava_queries(tuple(channels), tuple(params))
+	values = []
+	for q, s in zip(queries, query_chain(queries, PAVA_SIZE)):
+		v = parse_float(s, f"{q.replace('?', '')},", "V") # Response header echoes the query, e.g. "C1:PAVA PKPK,"
+		if v is not None:
+			values.append(v)
+		else:
+			errprint(f"Error parsing: {s}")
+			sys.exit(exitcode)
+	return values
+
+# Last vertical offset and scale set by vautoscale, by channel
+_last_ofst = {}
+_last_vdiv = {}
 
-def vautoscale(ch, iterations = 2, vdiv = 7.5):
-	"""Automatic vertical offset and scale adjustment."""
+def vautoscale(channels, iterations = 2, vdiv = 7.5):
+	"""Automatic vertical offset and scale adjustment. Returns whether any channel was adjusted."""
 	# Measures Vmin and Vmax, then adjusts vertical offset and scale
+	if isinstance(channels, str): channels = [channels] # Single channel, e.g. "C1"
+	adjusted = False
 	for i in range(0, iterations):
 		if i > 0: time.sleep(0.1)
-		s = dso.query(f"{ch}:PAVA? MIN").strip()
-		match1 = re.search(f"^{ch}:PAVA MIN,(.*)V$", s)
-		s = dso.query(f"{ch}:PAVA? MAX").strip()
-		match2 = re.search(f"^{ch}:PAVA MAX,(.*)V$", s)
-		if match1 and match2 and not match1.group(1).startswith("*") and not match2.group(1).startswith("*"):
-			vmin = float(match1.group(1))
-			vmax = float(match2.group(1))
+		values = measure_pava(channels, ("MIN", "MAX"), 1)
+		cmds = []
+		for idx, ch in enumerate(channels):
+			vmin = values[2 * idx]
+			vmax = values[2 * idx + 1]
 			vpp = vmax - vmin
 			v0 = vmin + vpp / 2
-			dso.write(f"{ch}:OFST {-v0:.5f}V")
-			dso.write(f"{ch}:VDIV {vpp / vdiv:.5f}V")
-		else:
-			errprint(f"Error parsing for vautoscale: {s}")
-			sys.exit(1)
+			ofst = f"{-v0:.5f}V"
+			if _last_ofst.get(ch) != ofst:
+				cmds.append(f"{ch}:OFST {ofst}")
+				_last_ofst[ch] = ofst
+			vscale = f"{vpp / vdiv:.5f}V"
+			if _last_vdiv.get(ch) != vscale:
+				cmds.append(f"{ch}:VDIV {vscale}")
+				_last_vdiv[ch] = vscale
+		if len(cmds) > 0:
+			dso.write(";".join(cmds))
+			for ch in channels: _chan_cal.pop(ch, None)
+			adjusted = True
+	return adjusted
+
+# Horizontal scales per division, in ascending order
+_HSCALE_STEPS = [(j * factor, f"{j}{unit}")
+	for unit, factor in (("ns", 1e-9), ("us", 1e-6), ("ms", 1e-3), ("s", 1))
+	for j in (1, 2, 5, 10, 20, 50, 100, 200, 500)]
+_HSCALE_TIMES = [t for t, _ in _HSCALE_STEPS]
+_HSCALE_NAMES = [name for _, name in _HSCALE_STEPS]
 
 def hscale(f):
 	"""Computes optimal horizontal scale for given frequency."""
 	t = 1 / (f * 4)
-	units = ("ns", "us", "ms", "s")
-	factors = (1e-9, 1e-6, 1e-3, 1)
-	for i in range(0, len(units)):
-		for j in (1, 2, 5, 10, 20, 50, 100, 200, 500):
-			if j * factors[i] > t: return f"{j}{units[i]}"
-	return "1s"
+	i = bisect.bisect_right(_HSCALE_TIMES, t)
+	if i == len(_HSCALE_TIMES): return "1s"
+	return _HSCALE_NAMES[i]
+
+def hscale_seconds(name):
+	"""Returns horizontal scale per division in seconds, e.g. 5e-4 for "500us"."""
+	return _HSCALE_TIMES[_HSCALE_NAMES.index(name)]
 
 def dBV(v):
 	return 20 * math.log10(v)
@@ -97,10 +186,8 @@ def dBV(v):
 def measure_hscale():
 	"""Returns horizontal scale per division."""
 	s = dso.query(f"TDIV?").strip()
-	match = re.search("^TDIV ([-+0-9.E]+)S$", s)
-	if match:
-		t = float(match.group(1))
-	else:
+	t = parse_float(s, "TDIV ", "S")
+	if t is None:
 		errprint(f"Error parsing: {s}")
 		sys.exit(2)
 	return t
@@ -108,59 +195,35 @@ def measure_hscale():
 def measure_vpp(ch):
 	"""Returns Vpp of given DSO channel."""
 	# Assumes optimal vertical scale
-	s = dso.query(f"{ch}:PAVA? PKPK").strip()
-	match = re.search(f"^{ch}:PAVA PKPK,(.*)V$", s)
-	if match and not match.group(1).startswith("*"):
-		vpp = float(match.group(1))
-	else:
-		errprint(f"Error parsing Vpp: {s}")
-		sys.exit(2)
-	return vpp
+	return measure_pava([ch], ("PKPK",))[0]
 
 def measure_mean(ch):
 	"""Returns mean of given DSO channel."""
 	# Assumes optimal vertical scale
-	s = dso.query(f"{ch}:PAVA? MEAN").strip()
-	match = re.search(f"^{ch}:PAVA MEAN,(.*)V$", s)
-	if match and not match.group(1).startswith("*"):
-		v = float(match.group(1))
-	else:
-		errprint(f"Error parsing V: {s}")
-		sys.exit(2)
-	return v
+	return measure_pava([ch], ("MEAN",))[0]
 
 def measure_level(ch):
 	"""Returns V of given DSO channel at the trigger point."""
 	# Assumes optimal vertical scale
-	s = dso.query(f"{ch}:PAVA? LEVELX").strip()
-	match = re.search(f"^{ch}:PAVA LEVELX,(.*)V$", s)
-	if match:
-		sample = float(match.group(1))
-	else:
-		errprint(f"Error parsing: {s}")
-		sys.exit(2)
-	return sample
+	return measure_pava([ch], ("LEVELX",))[0]
 
 def measure_phase(ch1, ch2):
 	"""Returns phase difference between two DSO channels."""
 	# Assumes optimal horizontal and vertical scales
 	dso.write(f"{ch2}-{ch1}:MEAD? PHA") # Query returns extra \xa1\xe3 data, so using read_raw
 	s = dso.read_raw()[:-2].decode()
-	match = re.search(f"^{ch2}-{ch1}:MEAD PHA,(.*)$", s)
-	if match:
-		if match.group(1).startswith("*"):
-			phase = 0
-		else:
-			phase = norm_angle(float(match.group(1)))
-	else:
+	header = f"{ch2}-{ch1}:MEAD PHA,"
+	if s.startswith(f"{header}*"): return 0 # Unavailable
+	phase = parse_float(s, header)
+	if phase is None:
 		errprint(f"Error parsing phase: {s}")
 		sys.exit(4)
-	return phase
+	return norm_angle(phase)
 
 def nsamples(ch):
 	"""Returns number of samples."""
 	s = dso.query(f"SANU? {ch}").strip()
-	match = re.search("^SANU (.*)pts$", s)
+	match = _SANU_RE.match(s)
 	if match:
 		n = float(match.group(1))
 	else:
@@ -168,33 +231,62 @@ def nsamples(ch):
 		sys.exit(5)
 	return math.floor(n)
 	
-def fetch(ch):
+def request_waveform(ch, start, count, stride = 1):
+	"""Requests waveform data of a channel, to be read with read_bytes."""
+	dso.write(f"WFSU SP,{stride},NP,{count},FP,{start}")
+	dso.write(f"{ch}:WF? DAT2")
+
+def fetch(ch, batchsize = 20):
 	"""Returns waveform data of a channel."""
-	vscale = measure_vscale(ch)
-	voffset = measure_voffset(ch)
-	data = array.array('f')
-	stride = 1
-	batchsize = 20 # Apparent limit on SDS1104X-U
+	import numpy as np # Imported here, so scripts that do not fetch waveforms only require pyvisa
+	# Batches of more than 20 samples are unreliable on the SDS1104X-U
+	vscale, voffset = measure_cal([ch])[0]
 	n = nsamples(ch)
+	data = np.empty(n + 1, dtype=np.float32) # The last batch may contain one extra sample
+	pos = 0
+	if n > 0: request_waveform(ch, 0, batchsize)
+	prefix = f"{ch}:WF DAT2,#9".encode()
 	for i in range(0, n, batchsize):
-		dso.write(f"WFSU SP,{stride},NP,{batchsize},FP,{i}")
-		dso.write(f"{ch}:WF? DAT2")
-		rawdata = dso.read_raw()
 		remaining = min(batchsize, n - i + 1)
-		header = f"{ch}:WF DAT2,#90{remaining:08d}"
-		if (rawdata[0:len(header)].decode() == header):
-			for b in list(rawdata[len(header): -2]):
-				if b > 127: b = b - 256
-				v = b * (vscale / 25) - voffset
-				data.append(v)
+		# Block data is preceded by a header with its length, e.g. "C1:WF DAT2,#9000000020", and followed by two
+		# terminator bytes. Reads exact lengths, as scanning for a termination character could match a sample.
+		try:
+			header = dso.read_bytes(len(prefix) + 9)
+			count = int(header[len(prefix):]) if header.startswith(prefix) and header[len(prefix):].isdigit() else -1
+			rawdata = dso.read_bytes(count + 2) if count >= 0 else b""
+		except pyvisa.errors.VisaIOError as e:
+			errprint(f"Error reading waveform data: {e}")
+			sys.exit(6)
+		if count == remaining:
+			# Requests the next batch before decoding this one, so the DSO prepares it in the meantime
+			if i + batchsize < n: request_waveform(ch, i + batchsize, batchsize)
+			# Signed 8-bit samples
+			samples = np.frombuffer(rawdata, dtype=np.int8, count=count)
+			data[pos:pos + len(samples)] = samples * (vscale / 25) - voffset
+			pos += len(samples)
 		else:
-			errprint(f"Error parsing: {rawdata}")
+			errprint(f"Error parsing: {header + rawdata}")
 			sys.exit(6)
-	return data
+	return data[:pos]
+
+def configure(instr):
+	"""Configures VISA session for SCPI transfers."""
+	instr.chunk_size = 1024 * 1024 # Reads complete responses with a single low-level call
+	instr.write_termination = '\n'
+	instr.timeout = 5000
+	instr.query_delay = 0
+	try:
+		# Disables Nagle's algorithm on PyVISA-py TCPIP sockets, which delays small SCPI commands.
+		# NI-VISA already does so by default, and other interfaces have no such socket.
+		interface = instr.visalib.sessions[instr.session].interface
+		sock = getattr(interface, 'sock', interface)
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	except (AttributeError, KeyError, OSError):
+		pass
 
 def close_resources():
-	for instr in resources:
-		resources[instr].close()
+	for instr in resources.values():
+		instr.close()
 
 rm = pyvisa.ResourceManager()
 resources = {}
@@ -211,19 +303,18 @@ try:
 	if 'psu_instr' in defaults:
 		resources['psu'] = rm.open_resource(defaults['psu_instr'])
 
-	for instr in rm.list_resources():
-		match = re.search("::SDS.*::INSTR$", instr)
-		if match:
-			resources['dso'] = rm.open_resource(instr)
-		match = re.search("::SDG.*::INSTR$", instr)
-		if match:
-			resources['awg'] = rm.open_resource(instr)
-		match = re.search("::SPD.*::INSTR$", instr)
-		if match:
-			resources['psu'] = rm.open_resource(instr)
+	# Discovers instruments missing from the configuration; enumerating VISA resources is slow, so skipped if all are configured
+	if len(resources) < len(_INSTR_RES):
+		for instr in rm.list_resources():
+			for name, pattern in _INSTR_RES.items():
+				if name not in resources and pattern.search(instr):
+					resources[name] = rm.open_resource(instr)
 except OSError as e:
 	sys.exit(f"Unable to connect to instrument: {e}")
 
+for instr in resources:
+	configure(resources[instr])
+
 dso = resources['dso'] if 'dso' in resources else None
 awg = resources['awg'] if 'awg' in resources else None
 psu = resources['psu'] if 'psu' in resources else None
@@ -232,4 +323,14 @@ psu = resources['psu'] if 'psu' in resources else None
 if __name__ == "__main__":
 	assert norm_angle(240) == -120
 	assert vunit(2.5e-3) == "2.5mV"
+	assert vunit(0) == "1uV"
+	assert hscale(1000) == "500us"
+	assert hscale(100000) == "5us"
+	assert hscale_seconds("500us") == 5e-4
+	assert parse_float("C1:PAVA PKPK,1.23E-01V", "C1:PAVA PKPK,", "V") == 0.123
+	assert parse_float("C1:PAVA MIN,****V", "C1:PAVA MIN,", "V") == None
+	assert parse_float("C1:PAVA PKPK,2.00E+00V", "C2:PAVA MEAN,", "V") == None
+	assert parse_float("TDIV 1.00E-03S", "TDIV ", "S") == 1e-3
+	assert parse_float("C1:PAVA MIN,-1.00E+00V", "C1:VDIV ", "V") == None
+	assert parse_float("C1:VDIV ****V", "C1:VDIV ", "V") == None
 	
\ No newline at end of file
@@ -16,7 +16,7 @@ import datetime
 import re
 import argparse
 import pyvisa
-import matplotlib.pyplot as plt
+import numpy as np
 from eelib import *
 
 def wait():
@@ -26,6 +26,7 @@ def wait():
 
 def plot(xpts, ypts, channels):
 	"""Plots V of given channels."""
+	import matplotlib.pyplot as plt # Imported here, as it is slow to load
 	colors = [ 'gold', 'magenta', 'cyan', 'limegreen' ]
 	fig, ax1 = plt.subplots()
 	ax1.set_xlabel("Time [s]")
@@ -40,9 +41,13 @@ parser = argparse.ArgumentParser(
 	epilog="Fetches and plots up to 14,000 data points from the active SDS1104X-U scope channels, optionally averaging multiple sweeps."
 )
 parser.add_argument('-n', type=int, dest='navg', default=1, metavar='navg', help="Number of sweeps to average (default is 1)")
+parser.add_argument('-b', type=int, dest='batchsize', default=20, metavar='batchsize', help="Number of data points per transfer (default is 20)")
 args = parser.parse_args()
 
 navg = args.navg
+if args.batchsize < 1:
+	errprint(f"Error: Batch size must be at least 1")
+	sys.exit(3)
 
 channels = active_channels()
 if len(channels) == 0: sys.exit(0)
@@ -56,27 +61,21 @@ for ch in channels:
 		sys.exit(2)
 
 hdiv = measure_hscale();
-ypts = []
+measure_cal(channels) # Queries vertical scales and offsets of all channels at once
+ypts = np.zeros((len(channels), n))
 
 for i in range(0, navg):
 	if i > 0: wait()
 	dso.write(f"STOP")
 	for c, ch in enumerate(channels):
 		errprint(f"Fetching {n} data points of {ch} (sweep {i + 1} of {navg})")
-		data = fetch(ch)
-		if i == 0: ypts.append([0] * n)
-		for j in range(0, n): ypts[c][j] = ypts[c][j] + data[j]
+		ypts[c] += fetch(ch, args.batchsize)[:n]
 	dso.write(f"ARM")
 
-for c, ch in enumerate(channels):
-	for j in range(0, n): ypts[c][j] = ypts[c][j] / navg
+ypts /= navg
 
 close_resources()
 
-t = -7 * hdiv
 dt = hdiv * 14 / n
-xpts = []
-for j in range(0, n):
-	xpts.append(t)
-	t = t + dt
+xpts = np.linspace(-7 * hdiv, 7 * hdiv - dt, n)
 plot(xpts, ypts, channels)